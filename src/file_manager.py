@@ -30,6 +30,7 @@ License:     GPLv3
 import errno
 import tarfile
 import os
+import shutil
 from pathlib import Path
 
 from tools import Counter
@@ -80,14 +81,17 @@ def create_instance_directories(
 
 def store_counter_output(command: str,
                          path_to_instance: str,
-                         counter_output: str,
+                         counter_output,
                          counter: Counter,
                          log_dir: str):
-
+    """ Write command and the output of the counter, given as a text file
+    object positioned at its start, to a log file. The output is copied in
+    chunks, so large outputs are never held in memory as a whole.
+    """
     log_file = f"{log_dir}/{get_file_name(path_to_instance)}_{counter.name}_output.log"
-    with open(log_file, 'w') as lf:
-        lf.write(f"$ {command}\n")
-        lf.write(counter_output)
+    with open(log_file, 'w', buffering=1 << 20) as out_file:
+        out_file.write(f"$ {command}\n")
+        shutil.copyfileobj(counter_output, out_file, 1 << 20)
     return log_file
 
 
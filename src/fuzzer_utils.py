@@ -29,20 +29,22 @@ Description: This module contains helper functions for the SharpVelvet fuzzer.
 
 """
 
-from collections import namedtuple
+from dataclasses import dataclass
 from decimal import Decimal
-from functools import partial
+from functools import lru_cache, partial
 from fractions import Fraction
 from math import isnan
 from pathlib import Path
 
-import pandas as pd
 from gmpy2 import mpz, log10, mpfr
-import json
+import mmap
 import os
 import re
 import resource
+import shutil
+import signal
 import subprocess
+import tempfile
 import time
 
 from tools import *
@@ -50,10 +52,30 @@ import file_manager as fm
 import report_manager as rm
 
 
-Count = namedtuple("Count", "solver preproc count", defaults=[None, None, -1])
+@dataclass(frozen=True, slots=True)
+class Count:
+    solver: str | None = None
+    preproc: str | None = None
+    count: int = -1
 
-Instance = namedtuple("Instance", "path problem_type n_vars n_clss proj_vars lits2weights",
-                           defaults=[None, None, None, None, None, None])
+
+@dataclass(frozen=True, slots=True)
+class Instance:
+    path: str | None = None
+    problem_type: str | None = None
+    n_vars: int | None = None
+    n_clss: int | None = None
+    proj_vars: set | None = None
+    lits2weights: dict | None = None
+
+# Problem type of an instance with projected variables, keyed by
+# (all variables are projected, some literals are weighted)
+inferred_problem_types = {
+    (True, False): "mc",
+    (False, False): "pmc",
+    (True, True): "wmc",
+    (False, True): "pwmc",
+}
 
 # The following regular expressions are all based on the information in
 # https://mccompetition.org/assets/files/mccomp_format_24.pdf
@@ -64,30 +86,38 @@ type_pat = re.compile(r'\s*c\s+s\s+type\s+(?P<problem_type>((w)|(p)|(pw))?mc)\s*
 est_pat = re.compile(r'\s*c\s+s\s+(?P<est_type>(neg)?log10-estimate)\s+(?P<est_val>[\d.e\-inf]+)\s*', re.DOTALL)
 count_pat = re.compile(r'\s*c\s+s\s+(?P<counter_type>((exact)|(approximate)))\s+(?P<precision>((arb)|(single)|(double)|(quadruple)))\s+(?P<notation>((log10)|(float)|(prec-sci)|(int)|(frac)))\s+(?P<value>((inf)|(\d+\.*\d*)))\s*', re.DOTALL)
 gen_pat = re.compile(r'.*/instances/p?w?cnf/(?P<generator>[\w-]+)_\d+_s\d+\.p?w?cnf', re.DOTALL)
+sci_pat = re.compile(r'^[+-]?\d+(\.\d+)?[eE][+-]?\d+$')
 # TODO: add functionality for pac guarantees
 
 # REGEX for parsing verifier output
 # trace_pat = re.compile(r'reading from \"(?P<trace_file>.*\.trace)\"...done', re.DOTALL)
 verified_count_pat = re.compile(r'(root)?\s*(m|M)odel count: (?P<verified_count>\d+)\s*', re.DOTALL)
+# Any line that parse_verifier_output acts on contains one of these
+verifier_marker_pat = re.compile(r'odel count: |proofs verified|PROOF SUCCESSFUL|IntegrityError\(NoRootClaim\)'
+                                 r'|proof done but some clause|Assertion |(?i:error)')
+
+# REGEX for finding the header lines of a DIMACS file, used by parse_cnf
+cnf_header_pat = re.compile(rb'^[ \t]*(?:p |c t |c p )[^\n]*', re.MULTILINE)
 
 
 def fstr(template, **kwargs):
-    return eval(f"f'{template}'", kwargs)
+    """ Fill in the {PLACEHOLDERS} in a tool configuration template. Uses
+    str.format_map instead of evaluating the template as an f-string, so no
+    code is compiled or executed per call.
+    """
+    return template.format_map(kwargs)
 
 
 def abs_path(relative_path: str):
     return os.path.abspath(relative_path)
 
 
-def set_limits(t):
-    """
-
-    :param t:
-    :return:
+@lru_cache(maxsize=None)
+def cpu_limiter(t: int):
+    """ Return a function that limits the CPU time of the calling process to t
+    seconds, for use as a preexec_fn. Cached, so each timeout gets one function.
     """
-    # Set maximum CPU time to 1 second in child process, after fork() but before exec()
-    rm.log_message(f"Setting resource limit in child (pid {os.getpid()})")
-    resource.setrlimit(resource.RLIMIT_CPU, (t, t))
+    return partial(resource.setrlimit, resource.RLIMIT_CPU, (t, t))
 
 
 def is_nan_or_none(value):
@@ -108,13 +138,34 @@ def is_nan_or_none(value):
     return False
 
 
-def construct_command(counter, path_to_instance, memout, timeout):
-    counter_dir = str(Path(counter.path).parent.absolute())
-    if '{INSTANCE}' in counter.config:
-        tmp_command = f"./{os.path.basename(counter.path)} {counter.config}"
-    else:
-        tmp_command = f"./{os.path.basename(counter.path)} {counter.config} {path_to_instance}"
-    return fstr(tmp_command, STAREXEC_MAX_MEM=memout, STAREXEC_WALLCLOCK_LIMIT=timeout, INSTANCE=path_to_instance, TMP='/scratch/aldlatour/sharpfuzz'), counter_dir
+def counter_argv(basename: str, config: str) -> tuple:
+    """ Argument templates for calling a counter, with the {INSTANCE}
+    placeholder appended if the configuration does not mention it.
+    """
+    if '{INSTANCE}' in config:
+        return tuple(f"./{basename} {config}".split())
+    return tuple(f"./{basename} {config} {{INSTANCE}}".split())
+
+
+@lru_cache(maxsize=None)
+def counter_env(memout, timeout) -> dict:
+    """ Environment for running a counter, with the StarExec resource limits
+    set. Cached, since all runs with the same limits share it. Do not modify
+    the returned dict.
+    """
+    env = dict(os.environ)
+    env['STAREXEC_WALLCLOCK_LIMIT'] = str(timeout)
+    env['STAREXEC_MAX_MEM'] = str(memout)
+    return env
+
+
+def construct_command(counter, path_to_instance, memout, timeout) -> (list, str):
+    """ Fill in the argument templates of counter, so that the instance path is
+    passed as a single argument, even if it contains spaces.
+    """
+    argv = [fstr(arg, STAREXEC_MAX_MEM=memout, STAREXEC_WALLCLOCK_LIMIT=timeout, INSTANCE=path_to_instance, TMP='/scratch/aldlatour/sharpfuzz')
+            for arg in counter.argv]
+    return argv, counter.dir
 
 
 def handle_errors(err, verbosity):
@@ -135,32 +186,87 @@ def handle_timeout(start_time, timeout, counter_name, path_to_instance):
     return False
 
 
-def parse_counter_output(counter_output, counter, path_to_instance, timed_out, error, log_dir, command):
-    success, result = parse_output(counter_output, counter, path_to_instance, timed_out=timed_out, error=error)
-    if not success:
-        log_file = fm.store_counter_output(
-            command=command, path_to_instance=path_to_instance,
-            counter_output=counter_output, counter=counter, log_dir=log_dir)
-        rm.log_message(f"ERROR when running {counter.name}. Output written to {log_file}")
+def parse_counter_output(process, counter, path_to_instance, start_time, timeout, log_dir, command):
+    """ Parse the output of a running counter line by line, while the counter
+    is still producing it. Only if parsing fails is the full output written
+    to a log file. Until then, a copy of the output is kept in a spooled
+    temporary file, so large outputs do not have to be held in memory.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20, mode='w+') as output_copy:
+        success, result = parse_output(tee_lines(process.stdout, output_copy), counter, path_to_instance)
+        # Read whatever the counter prints after parsing stopped, so it can finish
+        shutil.copyfileobj(process.stdout, output_copy)
+        process.wait()
+        result['timed_out'] = handle_timeout(start_time=start_time, timeout=timeout,
+                                             counter_name=counter.name, path_to_instance=path_to_instance)
+        if not success:
+            output_copy.seek(0)
+            log_file = fm.store_counter_output(
+                command=command, path_to_instance=path_to_instance,
+                counter_output=output_copy, counter=counter, log_dir=log_dir)
+            rm.log_message(f"ERROR when running {counter.name}. Output written to {log_file}")
     return result
 
 
-def run(command: str,
-        dir: str,
-        verbosity=1,
-        timeout=10):
+def tee_lines(lines, copy):
+    """ Yield the given lines, writing a copy of each line to file copy. """
+    for line in lines:
+        copy.write(line)
+        yield line
+
+
+def start(command: str,
+          dir: str,
+          verbosity=1,
+          timeout=10,
+          env=None,
+          new_session=False) -> subprocess.Popen:
+    """ Start command in dir, with its stdout and stderr available through the
+    stdout of the returned process. If env is given, it replaces the
+    environment of the process. With new_session, the process leads a new
+    process group, which kill_process_group can kill as a whole.
+    """
     if verbosity >= 2:
         rm.log_message(f'--> Executing: {" ".join(command)} in dir {dir}')
     if verbosity >= 3:
         rm.log_message(f'CPU limit of parent (pid {os.getpid()}): {resource.getrlimit(resource.RLIMIT_CPU)}')
 
-    this_dir = os.path.dirname(os.path.realpath(__file__))
-    os.chdir(dir)
-    p = subprocess.Popen(command, stderr=subprocess.STDOUT,
-                         stdout=subprocess.PIPE, universal_newlines=True,
-                         preexec_fn=partial(set_limits, timeout))
-    os.chdir(this_dir)
+    if hasattr(resource, 'prlimit'):
+        # Without a preexec_fn, subprocess can start the child with vfork()
+        # instead of fork(), so the parent's memory is not copied. The CPU limit
+        # is then set on the child from the parent, right after spawning it.
+        p = subprocess.Popen(command, cwd=dir, stderr=subprocess.STDOUT,
+                             stdout=subprocess.PIPE, universal_newlines=True,
+                             env=env, start_new_session=new_session)
+        try:
+            resource.prlimit(p.pid, resource.RLIMIT_CPU, (timeout, timeout))
+        except ProcessLookupError:
+            pass  # Child already finished
+    else:
+        # No prlimit outside Linux: set the limit in the child, after fork()
+        # but before exec(). Nothing else should run there, so no logging.
+        p = subprocess.Popen(command, cwd=dir, stderr=subprocess.STDOUT,
+                             stdout=subprocess.PIPE, universal_newlines=True,
+                             preexec_fn=cpu_limiter(timeout), env=env,
+                             start_new_session=new_session)
+    return p
+
+
+def kill_process_group(process: subprocess.Popen):
+    """ Kill a process started with new_session, together with any processes
+    it started itself, which may still hold on to its stdout.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # All processes in the group already finished
+
 
+def run(command: str,
+        dir: str,
+        verbosity=1,
+        timeout=10):
+    p = start(command, dir, verbosity=verbosity, timeout=timeout)
     console_output, err = p.communicate()
     if verbosity >= 3:
         rm.log_message(
@@ -206,7 +312,7 @@ def normalize_count(count_str):
         return count_str
 
     # Check if the count is in scientific notation
-    if re.match(r'^[+-]?\d+(\.\d+)?[eE][+-]?\d+$', count_str):
+    if sci_pat.match(count_str):
         return mpfr(count_str)
 
     # Check if the count is a fraction
@@ -225,6 +331,13 @@ def get_random_seed(seed):
     return seed
 
 
+def extract_seed(file_name: str) -> int:
+    """ Get the seed from the name of a generated instance, which has the
+    form <generator>_<iteration>_s<seed>.<extension>.
+    """
+    return int(file_name.rsplit('_s', 1)[1].split('.', 1)[0])
+
+
 def get_extension(projected=False, weighted=False) -> str:
     if not projected and not weighted:
         return "cnf"
@@ -242,12 +355,23 @@ def parse_counters(counter_config_file: str):
     Parameters:
         counter_config_file (str): Path to json file with counter configuration
     """
-    counter_dict = json.load(open(counter_config_file))
-    counters = [Counter(name, counter_dict[name]["path"], counter_dict[name]["config"], bool(counter_dict[name]["exact"]))
+    counter_dict = rm.load_json(counter_config_file)
+    counters = [Counter(name, counter_dict[name]["path"], counter_dict[name]["config"], bool(counter_dict[name]["exact"]),
+                        dir=str(Path(counter_dict[name]["path"]).parent.absolute()),
+                        argv=counter_argv(os.path.basename(counter_dict[name]["path"]), counter_dict[name]["config"]))
                 for name in counter_dict]
     return counters
 
 
+def generator_template(path: str, config: str) -> str:
+    """ Command template for calling a generator, with the {out_file}
+    placeholder appended if the configuration does not mention it.
+    """
+    if '{out_file}' not in config:
+        return f"{path} {config} {{out_file}}"
+    return f"{path} {config}"
+
+
 def parse_generators(generator_config):
     """
     Read instance generators from a given json file or a dictionary.
@@ -259,14 +383,15 @@ def parse_generators(generator_config):
         list: List of Generator objects.
     """
     if isinstance(generator_config, str):
-        with open(generator_config, 'r') as file:
-            gen_dict = json.load(file)
+        gen_dict = rm.load_json(generator_config)
     elif isinstance(generator_config, dict):
         gen_dict = generator_config
     else:
         raise ValueError("Input must be a string (path to a file) or a dictionary.")
 
-    generators = [Generator(name, gen_dict[name]["path"], gen_dict[name]["config"]) for name in gen_dict]
+    generators = [Generator(name, gen_dict[name]["path"], gen_dict[name]["config"],
+                            template=generator_template(gen_dict[name]["path"], gen_dict[name]["config"]))
+                  for name in gen_dict]
     assert generators, "Aborting. Please specify at least one instance generator."
     return generators
 
@@ -279,7 +404,7 @@ def parse_preprocessors(preprocessor_config_file: str):
     """
     preprocessors = []
     if preprocessor_config_file is not None:
-        prep_dict = json.load(open(preprocessor_config_file))
+        prep_dict = rm.load_json(preprocessor_config_file)
         preprocessors = [Preprocessor(name, prep_dict[name]["path"], prep_dict[name]["config"]) for name in prep_dict]
     return preprocessors
 
@@ -287,12 +412,13 @@ def parse_preprocessors(preprocessor_config_file: str):
 def get_instance_list(path_to_instances):
     if os.path.isdir(path_to_instances):
         abs_path = os.path.abspath(path_to_instances)
-        return [f"{abs_path}/{file_name}"
-                for file_name in os.listdir(abs_path)
-                if os.path.isfile(f"{abs_path}/{file_name}")]
+        # scandir gets the file type from the directory listing itself, so
+        # no extra stat() call is needed per entry
+        with os.scandir(abs_path) as entries:
+            return [entry.path for entry in entries if entry.is_file()]
     elif os.path.isfile(path_to_instances):
         with open(path_to_instances, 'r') as infile:
-            return [filename.strip() for filename in infile.readlines()]
+            return [filename.strip() for filename in infile]
     else:
         print("ERROR: please provide a path to a directory with problem instances "
               "or a path to a file with a path to a problem instance on each line.")
@@ -306,52 +432,52 @@ def parse_cnf(path_to_cnf: str) -> Instance:
     proj_vars = set()
     lits2weights = dict()
     problem_type = ''
-    with (open(path_to_cnf, 'r') as infile):
-        for line in infile.readlines():
-            line = line.strip()
-            # DIMACS HEADER
-            if line.startswith("p "):
-                _, inst_type, n_vars_str, n_clss_str = line.split()
-                n_vars = int(n_vars_str)
-                n_clss = int(n_clss_str)
-                assert inst_type in ["cnf", "wcnf", "pcnf", "pwcnf"], \
-                    f"Invalid instance type: {inst_type} for {path_to_cnf}."
-            # OPTIONAL MODEL COUNTING HEADER
-            elif line.startswith("c t "):
-                _, _, problem_type = line.split()
-                assert problem_type in ["mc", "wmc", "pmc", "pwmc", ""], \
-                    f"Invalid problem type: {problem_type} for {path_to_cnf}."
-            # WEIGHTED LITERALS
-            elif line.startswith("c p "):
-                _, _, w_lit, weight, zero = line.split()
-                assert zero == '0', \
-                    f"Invalid weight specification in {path_to_cnf}."
-                lits2weights[int(w_lit)] = weight
-            # PROJECTED VARIABLES
-            elif line.startswith("c p show "):
-                new_proj_vars = set([int(var) for var in line.split()[2:-1]])
-                proj_vars = proj_vars.union(new_proj_vars)
+    with open(path_to_cnf, 'rb') as infile:
+        # Map the file into memory and let the regex engine search for the
+        # header lines, so the clause lines that make up the bulk of the file
+        # are skipped in C rather than in a Python loop.
+        if os.fstat(infile.fileno()).st_size > 0:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                header_lines = [m.group().decode() for m in cnf_header_pat.finditer(mm)]
+        else:
+            header_lines = []
+    for line in header_lines:
+        fields = line.split()
+        # DIMACS HEADER
+        if fields[0] == 'p':
+            _, inst_type, n_vars_str, n_clss_str = fields
+            n_vars = int(n_vars_str)
+            n_clss = int(n_clss_str)
+            assert inst_type in ["cnf", "wcnf", "pcnf", "pwcnf"], \
+                f"Invalid instance type: {inst_type} for {path_to_cnf}."
+        # OPTIONAL MODEL COUNTING HEADER
+        elif fields[1] == 't':
+            _, _, problem_type = fields
+            assert problem_type in ["mc", "wmc", "pmc", "pwmc", ""], \
+                f"Invalid problem type: {problem_type} for {path_to_cnf}."
+        # PROJECTED VARIABLES
+        elif fields[2] == 'show':
+            proj_vars.update(int(var) for var in fields[3:-1])
+        # WEIGHTED LITERALS
+        else:
+            _, _, w_lit, weight, zero = fields
+            assert zero == '0', \
+                f"Invalid weight specification in {path_to_cnf}."
+            lits2weights[int(w_lit)] = weight
 
     # Do some sanity checks and clean up
     assert n_vars != 0, f"ERROR: Cannot find 'p cnf' in {path_to_cnf}"
     # TODO: do sanity checks on the given weights
 
-    if len(proj_vars) == n_vars and not lits2weights:
-        if problem_type != "mc":
-            rm.log_message(f"WARNING: changing problem type from {problem_type} to mc, since all variables are projected and none are weighted.")
-        problem_type = "mc"
-    elif proj_vars and not lits2weights:
-        if problem_type != "pmc":
-            rm.log_message(f"WARNING: changing problem type from {problem_type} to pmc, since some variables are projected and none are weighted.")
-        problem_type = "pmc"
-    elif len(proj_vars) == n_vars and lits2weights:
-        if problem_type != "wmc":
-            rm.log_message(f"WARNING: changing problem type from {problem_type} to wmc, since all variables are projected and some are weighted.")
-        problem_type = "wmc"
-    elif proj_vars and lits2weights:
-        if problem_type != "pwmc":
-            rm.log_message(f"WARNING: changing problem type from {problem_type} to pwmc, since some variables are projected and some are weighted.")
-        problem_type = "pwmc"
+    if proj_vars:
+        all_projected = len(proj_vars) == n_vars
+        weighted = bool(lits2weights)
+        new_type = inferred_problem_types[(all_projected, weighted)]
+        if problem_type != new_type:
+            rm.log_message(f"WARNING: changing problem type from {problem_type} to {new_type}, "
+                           f"since {'all' if all_projected else 'some'} variables are projected "
+                           f"and {'some' if weighted else 'none'} are weighted.")
+        problem_type = new_type
 
     # Return info about instance
     instance_info = Instance(path=path_to_cnf, problem_type=problem_type, n_vars=n_vars, n_clss=n_clss, proj_vars=proj_vars, lits2weights=lits2weights)
@@ -370,15 +496,15 @@ def load_verified_counts(verified_counts_path):
     """
     if verified_counts_path is None:
         return None
+    # Imported here, so that scripts that never load verified counts (e.g.,
+    # generate_instances.py) do not pay for importing pandas
+    import pandas as pd
     verified_counts_df = pd.read_csv(verified_counts_path, dtype={'verified_count': str})
-    verified_counts_dict = {
-        row['instance']: {col: row[col] for col in verified_counts_df.columns if col != 'instance'}
-        for _, row in verified_counts_df.iterrows()
-    }
+    verified_counts_dict = verified_counts_df.set_index('instance').to_dict('index')
     return verified_counts_dict
 
 def parse_output(
-        counter_output: str,
+        counter_output,
         counter: Counter,
         path_to_instance: str,
         timed_out=False,
@@ -403,7 +529,11 @@ def parse_output(
     if verbosity >= 3:
         rm.log_message("OUTPUT")
 
-    for l in counter_output.split("\n"):
+    for l in counter_output:
+        # Optional information usually makes up most of the output. Unless
+        # every line is printed anyway, skip it before copying it with strip().
+        if verbosity < 3 and l.startswith('c o'):
+            continue
         l = l.strip()
 
         # Print each line of the counter's output, if verbosity level is high enough
@@ -430,21 +560,28 @@ def parse_output(
             result['error']: True
             return False, result
 
-        # Process lines to retrieve relevant data for reporting and sanity checks
-        m = re.match(sat_pat, l)
-        if m is not None:
-            result['satisfiability'] = m.group("satisfiability")
+        # Process lines to retrieve relevant data for reporting and sanity checks.
+        # Solution lines start with 's' and all other relevant lines with 'c',
+        # and cheap substring checks rule out the patterns that cannot match.
+        if l[:1] == 's':
+            m = sat_pat.match(l)
+            if m is not None:
+                result['satisfiability'] = m.group("satisfiability")
             continue
-        m = re.match(type_pat, l)
-        if m is not None:
-            result['problem_type'] = m.group("problem_type")
+        if l[:1] != 'c':
             continue
-        m = re.match(est_pat, l)
-        if m is not None:
-            result['est_type'] = m.group("est_type")
-            result['est_val'] = m.group("est_val")  # TODO: check what should happen if neglog10
-            continue
-        m = re.match(count_pat, l)
+        if 'type' in l:
+            m = type_pat.match(l)
+            if m is not None:
+                result['problem_type'] = m.group("problem_type")
+                continue
+        if 'estimate' in l:
+            m = est_pat.match(l)
+            if m is not None:
+                result['est_type'] = m.group("est_type")
+                result['est_val'] = m.group("est_val")  # TODO: check what should happen if neglog10
+                continue
+        m = count_pat.match(l)
         if m is not None:
             result['counter_type'] = m.group("counter_type")
             result['count_precision'] = m.group("precision")
@@ -455,7 +592,7 @@ def parse_output(
 
 
 def get_generator(path_to_instance: str) -> str:
-    m = re.match(gen_pat, path_to_instance)
+    m = gen_pat.match(path_to_instance)
     if m is not None:
         return m.group('generator')
     return "unknown"
@@ -464,10 +601,13 @@ def get_generator(path_to_instance: str) -> str:
 def check_counts(counts: dict) -> bool:
     # TODO: Add functionality for approximate counters
     # TODO: Add functionality for weighted & projected counters
-    # If all counts agree, return True
-    if len(set([normalize_count(count) for count in counts.values()])) == 1:
-        return True
-    return False
+    # If all counts agree, return True. Compare against the first count, so we
+    # can stop normalizing as soon as one count disagrees.
+    values = list(counts.values())
+    if not values:
+        return False
+    reference = normalize_count(values[0])
+    return all(normalize_count(count) == reference for count in values[1:])
 
 
 def parse_verifier_output(path_to_instance: str, output_file: str, timed_out:bool, error: bool, verbosity=1) -> (bool, dict):
@@ -483,10 +623,14 @@ def parse_verifier_output(path_to_instance: str, output_file: str, timed_out:boo
               'no_root_claim': False,
               'verified_count': None}
     with (open(output_file, 'r') as out_file):
-        for l in out_file.readlines():
+        for l in out_file:
+            # Most lines contain none of the markers checked below, so skip
+            # them after a single search
+            if verifier_marker_pat.search(l) is None:
+                continue
             l = l.strip()
 
-            m = re.match(verified_count_pat, l)
+            m = verified_count_pat.match(l)
             if m is not None:
                 result['verified_count'] = m.group("verified_count")
                 if result['verified_count'] == '0':
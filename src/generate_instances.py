@@ -33,21 +33,24 @@ Description: This script generates CNF in DIMACS format for model counting
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
 from datetime import datetime
+from functools import partial
+import numpy as np
 import os
 from pathlib import Path
-import random
 import re
+import shutil
 import subprocess
 import time
-import pandas as pd
 
 # Fuzzer modules
 import file_manager as fm
 import fuzzer_utils as fut
 import report_manager as rm
 
-seed_pat = re.compile(r'.*_\d{3}_s(?P<seed>\d+)\.\w+', re.DOTALL)
+shell_chars_pat = re.compile(r'[|&;<>()$`\\"\'*?~\[\]#{}!]')
 
 SHARPVELVET_DIR = Path(os.path.dirname(__file__)).parent.absolute()
 
@@ -126,6 +129,10 @@ def parse_arguments():
         "--memout", dest="memout", type=int, required=False, default=8000,
         help="Specify how much memory (in MB) the verifier gets to obtain a verified model count."
     )
+    verification.add_argument(
+        "--verifier-jobs", dest="verifier_jobs", type=int, required=False, default=1,
+        help="Maximum number of verifier runs to run in parallel. Each run may use up to --memout memory."
+    )
     verification.add_argument(
         "--clean-up-proofs", dest="clean_up_proofs", default=False, required=False, action="store_true",
         help="Clean up all proof-related files after verified count has been obtained."
@@ -158,6 +165,10 @@ def parse_arguments():
         "--num-iter", "-n", dest="num_iter", type=int, default=100,
         required=False, help="Specify the maximum number of iterations."
     )
+    admin.add_argument(
+        "--jobs", "-j", dest="jobs", type=int, default=os.cpu_count(),
+        required=False, help="Maximum number of generator calls to run in parallel."
+    )
     admin.add_argument(
         "--out-dir", dest="out_dir", type=str, required=False,
         help="Specify path to directory to store generated instances. Default: /path/to/fuzzer/out"
@@ -194,16 +205,42 @@ def parse_arguments():
     return parsed_args
 
 
+def split_command(command: str):
+    """ Split a generator command into an argument list and, if the command
+    ends with '> file', the file to redirect stdout to. This lets us call the
+    generator directly instead of through /bin/sh. Returns (None, None) if the
+    command uses any other shell features.
+    """
+    argv = command.split()
+    out_path = None
+    if len(argv) >= 3 and argv[-2] == '>':
+        argv, out_path = argv[:-2], argv[-1]
+    if any(shell_chars_pat.search(arg) for arg in argv + [out_path or '']):
+        return None, None
+    # A leading VAR=value sets an environment variable for the command
+    if not argv or '=' in argv[0]:
+        return None, None
+    return argv, out_path
+
+
 def generate_instance(generator: fut.Generator,
                       new_cnf_path: str,
                       seed: int,
                       verbosity=1
                       ):
-    tmp_command = f"{generator.path} {generator.config}"
-    if '{out_file}' not in generator.config:
-        tmp_command += ' {out_file}'
-    command = fut.fstr(tmp_command, out_file=new_cnf_path, seed=seed, PROJECT_DIR=SHARPVELVET_DIR)
-    status = subprocess.call(command, shell=True)
+    command = fut.fstr(generator.template, out_file=new_cnf_path, seed=seed, PROJECT_DIR=SHARPVELVET_DIR)
+    argv, out_path = split_command(command)
+    try:
+        if argv is None:
+            status = subprocess.call(command, shell=True)
+        elif out_path is None:
+            status = subprocess.call(argv)
+        else:
+            with open(out_path, 'w') as out_file:
+                status = subprocess.call(argv, stdout=out_file)
+    except OSError as e:
+        rm.log_message(f"Could not call generator: {e}")
+        status = -1
     if status != 0:
         rm.log_message(f"Failed generator call: {command}")
         exit(-1)
@@ -211,6 +248,7 @@ def generate_instance(generator: fut.Generator,
         rm.log_message(f"Called generator: {command}")
     elif verbosity >= 2:
         rm.log_message(f"Generated instance {new_cnf_path}.")
+    return new_cnf_path
 
 
 def generate_instances(generators: list,
@@ -218,7 +256,8 @@ def generate_instances(generators: list,
                        num_iter: int,
                        seed: int,
                        projected=False,
-                       weighted=False):
+                       weighted=False,
+                       jobs=1):
     ext = fut.get_extension(projected=projected, weighted=weighted)
     new_instances = []
     subdir = 'cnf'
@@ -229,13 +268,16 @@ def generate_instances(generators: list,
         subdir = 'pwcnf'
     elif projected and not weighted:
         subdir = 'pcnf'
-    for i in range(num_iter):
-        for generator in generators:
-            file_name = f"{cnf_dir}/{subdir}/{generator.name}_{i:03}_s{seed+i}.{ext}"
-            generate_instance(generator=generator, new_cnf_path=file_name, seed=seed+i)
+    prefix = f"{cnf_dir}/{subdir}/"
+    tasks = [(generator, f"{prefix}{generator.name}_{i:03}_s{seed+i}.{ext}", seed+i)
+             for i in range(num_iter) for generator in generators]
+    # Each generator call is an independent external process, so run several
+    # at once. Threads suffice, since the work happens in the subprocesses.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for n, file_name in enumerate(executor.map(lambda task: generate_instance(*task), tasks)):
             new_instances.append(file_name)
-        if i % progress_interval == progress_interval - 1:
-            rm.log_message(f"Progress: generated {(i+1) * len(generators)} / {num_iter * len(generators)} instances.")
+            if n % progress_interval == progress_interval - 1:
+                rm.log_message(f"Progress: generated {n+1} / {num_iter * len(generators)} instances.")
     return new_instances
 
 
@@ -245,37 +287,56 @@ def add_projection(path_to_instance: str,
     return
 
 
-def generate_float_weights(precision, negative):
+def generate_float_weights(precision, negative, n, rng):
     # TODO: build in functionality for very small weights
-    weight = random.uniform(0, 1)
-    formatted_weight = f"{weight:.{precision}f}"
+    weights = rng.random(n)
+    formatted_weights = np.char.mod(f"%.{precision}f", weights)
     if negative:
-        sign = random.choice(['-', ''])
-        return f"{sign}{formatted_weight}"
+        signs = rng.choice(['-', ''], size=n)
+        return np.char.add(signs, formatted_weights)
     else:
-        return str(formatted_weight), f"{1.0 - weight:.{precision}f}"
+        return formatted_weights, np.char.mod(f"%.{precision}f", 1.0 - weights)
 
 
-def generate_fractional_weights(precision, negative):
+def generate_fractional_weights(precision, negative, n, rng):
     max_val = 1000000
-    numerator = random.randint(1, max_val)
-    denominator = random.randint(1, max_val)
+    numerators = rng.integers(1, max_val, size=n, endpoint=True)
+    denominators = np.char.add('/', rng.integers(1, max_val, size=n, endpoint=True).astype(str))
 
     if negative:
-        sign = random.choice(['-', ''])
-        return f"{sign}{numerator}/{denominator}"
+        signs = rng.choice(['-', ''], size=n)
+        return np.char.add(np.char.add(signs, numerators.astype(str)), denominators)
     else:
-        return f"{numerator}/{denominator}", f"{max_val - numerator}/{denominator}"
+        return (np.char.add(numerators.astype(str), denominators),
+                np.char.add((max_val - numerators).astype(str), denominators))
 
 
-def generate_scientific_weights(precision, negative):
+def generate_scientific_weights(precision, negative, n, rng):
     # TODO: Implement scientific notation weights
     return
 
 
+def generate_mixed_weights(precision, negative, n, rng):
+    # TODO: include scientific notation weights once they are implemented
+    weight_generators = [generate_float_weights, generate_fractional_weights]
+    # Split the weights over the formats, generate each format in one batch,
+    # and shuffle the batches together
+    counts = rng.multinomial(n, [1 / len(weight_generators)] * len(weight_generators))
+    batches = [weight_generator(precision, negative, count, rng)
+               for weight_generator, count in zip(weight_generators, counts)]
+    order = rng.permutation(n)
+    if negative:
+        return np.concatenate(batches)[order]
+    else:
+        return (np.concatenate([weights1 for weights1, _ in batches])[order],
+                np.concatenate([weights2 for _, weights2 in batches])[order])
+
+
 def add_weights(path_to_instance: str,
                 out_dir: str,
-                args):
+                args,
+                rng,
+                verbosity=1):
 
     instance_info = fut.parse_cnf(path_to_cnf=path_to_instance)
     base_file = os.path.basename(path_to_instance)
@@ -295,52 +356,61 @@ def add_weights(path_to_instance: str,
     elif args.weight_format == "scientific":
         weight_generator = generate_scientific_weights
     elif args.weight_format == "mixed":
-        weight_generator = random.choice([generate_float_weights, generate_fractional_weights, generate_scientific_weights])
-    print(f"weight generator: {weight_generator}")
+        weight_generator = generate_mixed_weights
+    if verbosity >= 3:
+        rm.log_message(f"weight generator: {weight_generator.__name__}")
 
     n_weighted_vars = int(float(args.percentage_weighted) * 0.01 * instance_info.n_vars)
-    weighted_vars = random.sample(range(1, instance_info.n_vars), n_weighted_vars)
+    # Sample the weighted variables and their polarities in one batch
+    weighted_vars = rng.choice(instance_info.n_vars - 1, size=n_weighted_vars, replace=False) + 1
+    polarities = rng.integers(0, 2, size=n_weighted_vars) * 2 - 1
+    lits = polarities * weighted_vars
     lits2weights = dict()
 
-    for w_var in weighted_vars:
-        polarity = random.choice([-1, 1])
-        if not args.negative_weights:
-            w1, w2 = weight_generator(args.precision, args.negative_weights)
-            if args.both_weights_specified:
-                lits2weights[polarity * w_var] = w1
-                lits2weights[-1 * polarity * w_var] = w2
-
-    with open(path_to_instance, 'r') as infile:
-        with open(new_file, 'w') as outfile:
-            for line in infile.readlines():
-                if line.startswith("p"):
-                    outfile.write(line)
-                    outfile.write(f"c t {problem_type}\n")
-                    if instance_info.proj_vars:
-                        outfile.write("c p show " + " ".join([str(p_var) for p_var in instance_info.proj_vars]) + " 0 \n")
-                    for lit, weight in lits2weights.items():
-                        outfile.write(f"c p {lit} {weight} 0\n")
-                else:
-                    outfile.write(line)
+    if not args.negative_weights:
+        # Generate the weights for all weighted variables in one batch
+        weights1, weights2 = weight_generator(args.precision, args.negative_weights, n_weighted_vars, rng)
+        lits2weights = dict(zip(lits.tolist(), weights1.tolist()))
+        if args.both_weights_specified == "yes":
+            lits2weights.update(zip((-lits).tolist(), weights2.tolist()))
+        elif args.both_weights_specified == "sometimes":
+            # Give the opposite literal a weight for a random subset of the variables
+            both = rng.integers(0, 2, size=n_weighted_vars).astype(bool)
+            lits2weights.update(zip((-lits[both]).tolist(), weights2[both].tolist()))
+
+    # Lines to insert after the DIMACS header, built and encoded once and
+    # written in one go
+    header_extra = f"c t {problem_type}\n"
+    if instance_info.proj_vars:
+        header_extra += "c p show " + " ".join(map(str, instance_info.proj_vars)) + " 0 \n"
+    header_extra += "".join([f"c p {lit} {weight} 0\n" for lit, weight in lits2weights.items()])
+    header_extra = header_extra.encode()
+
+    with open(path_to_instance, 'rb') as infile:
+        with open(new_file, 'wb', buffering=1 << 20) as outfile:
+            for line in infile:
+                outfile.write(line)
+                if line.startswith(b"p"):
+                    outfile.write(header_extra)
+                    break
+            # The clauses that follow the header are copied over unchanged
+            shutil.copyfileobj(infile, outfile, 1 << 20)
     return new_file
 
 
 def get_ground_truth(
         path_to_instance: str,
         verifier_script: str,
-        out_dir: str,
+        verification_dir: str,
+        proof_dir: str,
         timeout=100,
         max_mem=3200,
         verbosity=1) -> dict:
     timed_out = False
-    error = False
     # TODO: figure out how to communicate time + space resources
     if verbosity >= 2:
         rm.log_message(f"Running verification script {verifier_script} on instance {path_to_instance}.")
 
-    verification_dir = str(Path(verifier_script).parent.absolute())
-    # proof_dir = f"{str(Path(Path(__file__).parent.absolute()).parent.absolute())}/proofs"
-    proof_dir = f"{out_dir}/verification"
     output_file = f"{proof_dir}/{os.path.basename(path_to_instance)}.output"
     tmp_command = f"./{os.path.basename(verifier_script)} {path_to_instance}"
     command = fut.fstr(tmp_command, STAREXEC_MAX_MEM=max_mem, STAREXEC_WALLCLOCK_LIMIT=timeout)
@@ -350,12 +420,7 @@ def get_ground_truth(
 
     start_time = time.time()
     verification_output, err = fut.run(command.split(), verification_dir + '/', verbosity=verbosity)
-    if err is None:
-        if verbosity >= 3:
-            rm.log_message("No error.")
-    else:
-        error = True
-        rm.log_message(f"Error: {err}")
+    error = fut.handle_errors(err, verbosity)
 
     # Abort if counter exceeds maximum time
     diff_time = time.time() - start_time
@@ -380,19 +445,23 @@ if __name__ == "__main__":
     args = parse_arguments()
 
     generators = fut.parse_generators(args.generators)
-    random.seed(args.rnd_seed)
 
     output_prefix = f"{datetime.now().strftime('%Y-%m-%d')}_s{args.rnd_seed}"
     new_dirs = fm.create_instance_directories(instance_dir=f"{args.out_dir}/instances", weighted=args.weighted, projected=args.projected)
     log_dir = f"{args.out_dir}/logs"
-    os.makedirs(f"{args.out_dir}/logs", exist_ok=True)
+    proof_dir = f"{args.out_dir}/verification"
+    # Set up all output directories before any instances are generated
+    os.makedirs(log_dir, exist_ok=True)
+    if args.verifier:
+        os.makedirs(proof_dir, exist_ok=True)
     rm.save_parameters(args, log_dir, output_prefix, os.path.basename(__file__))
 
     file_paths = generate_instances(
         generators=generators,
         cnf_dir=f"{args.out_dir}/instances",    # TODO: clean up
         num_iter=args.num_iter,
-        seed=args.rnd_seed)
+        seed=args.rnd_seed,
+        jobs=args.jobs)
     rm.log_message("")
     rm.log_message(f"Generated {len(file_paths)} problem instances.")
     rm.log_message(f"Saved problem instances to {Path(file_paths[0]).parent.resolve()}")
@@ -406,7 +475,9 @@ if __name__ == "__main__":
         rm.log_message(f"- percentage of weighted variables: {args.percentage_weighted}%")
         rm.log_message(f"- precision: {args.precision} significant digits")
 
-        file_paths_weighted = [add_weights(path_to_instance=file_path, out_dir=new_dirs['wcnf'], args=args)
+        rng = np.random.default_rng(args.rnd_seed)
+        file_paths_weighted = [add_weights(path_to_instance=file_path, out_dir=new_dirs['wcnf'], args=args, rng=rng,
+                                           verbosity=args.verbosity)
                                for file_path in file_paths]
         rm.log_message(f"Saved weighted problem instances to {Path(file_paths_weighted[0]).parent.resolve()}")
         file_paths = file_paths_weighted
@@ -419,24 +490,32 @@ if __name__ == "__main__":
     rm.log_message(f"Saved a list of all generated instances to {instances_list_file}")
 
     if args.verifier:
-        verified_counts = []
-        os.makedirs(f"{args.out_dir}/verification", exist_ok=True) # TODO: move this to file_manager.py
+        verification_dir = str(Path(args.verifier).parent.absolute())
         progress_interval = max(int(args.num_iter / 10.0), 1)
-        for i, file_path in enumerate(file_paths):
-            result = get_ground_truth(
-                path_to_instance=file_path,
-                verifier_script=args.verifier,
-                out_dir=args.out_dir,
-                timeout=args.timeout,
-                max_mem=args.memout)
-            if 'verified_count' in result:
-                result['verified_count'] = str(result['verified_count'])
-
-            verified_counts.append(result)
-            if i % progress_interval == progress_interval - 1:
-                rm.log_message(f"Progress: verified {(i+1)} / {args.num_iter * len(generators)} instances.", print_time=True)
-            df_results = pd.DataFrame(verified_counts)
-            df_results['verified_count'] = df_results['verified_count'].astype(str)
-            df_results.to_csv(f"{args.out_dir}/{output_prefix}_verified_counts.csv")
+        # Append each result to the csv as soon as it is available, rather than
+        # rewriting all results so far after every instance
+        with open(f"{args.out_dir}/{output_prefix}_verified_counts.csv", 'w', newline='') as csv_file:
+            writer = None
+            verify = partial(get_ground_truth,
+                             verifier_script=args.verifier,
+                             verification_dir=verification_dir,
+                             proof_dir=proof_dir,
+                             timeout=args.timeout,
+                             max_mem=args.memout)
+            # Like generation, verification runs in independent external
+            # processes, so several instances can be verified at once. Results
+            # still come back, and are written, in the order of file_paths.
+            with ThreadPoolExecutor(max_workers=args.verifier_jobs) as executor:
+                for i, result in enumerate(executor.map(verify, file_paths)):
+                    if 'verified_count' in result:
+                        result['verified_count'] = str(result['verified_count'])
+
+                    if i % progress_interval == progress_interval - 1:
+                        rm.log_message(f"Progress: verified {(i+1)} / {args.num_iter * len(generators)} instances.", print_time=True)
+                    if writer is None:
+                        writer = csv.DictWriter(csv_file, fieldnames=list(result.keys()))
+                        writer.writeheader()
+                    writer.writerow(result)
+                    csv_file.flush()
         # TODO: implement moving the verification information to the user-specified directory
 
@@ -29,16 +29,39 @@ License:     GPLv3
 """
 
 from datetime import datetime
+from functools import lru_cache
 import json
 import os
 import sys
+import time
+
+
+@lru_cache(maxsize=1)
+def timestamp(second: int) -> str:
+    """ Format a timestamp once per second, rather than once per message. """
+    return datetime.fromtimestamp(second).strftime("%Y-%m-%d, %Hh%Mm%Ss")
 
 
 def log_message(message: str, print_time=False):
+    # Each message is written with a single call, so that messages logged by
+    # several threads at once do not interleave. Only timestamped messages
+    # force a flush, so that bursts of plain messages in a loop are written
+    # out together.
     if print_time:
-        print(f'[SharpVelvet], {datetime.now().strftime("%Y-%m-%d, %Hh%Mm%Ss")}: {message}')
-    else: print(f'[SharpVelvet]: {message}')
-    sys.stdout.flush()
+        sys.stdout.write(f'[SharpVelvet], {timestamp(int(time.time()))}: {message}\n')
+        sys.stdout.flush()
+    else:
+        sys.stdout.write(f'[SharpVelvet]: {message}\n')
+
+
+@lru_cache(maxsize=None)
+def load_json(path: str):
+    """ Load a json file, e.g. a tool configuration. Cached, since the same
+    configuration files are read both for setting up a run and for saving
+    its parameters. Do not modify the returned object.
+    """
+    with open(path, 'r') as in_file:
+        return json.load(in_file)
 
 
 def print_counts(same_counts: bool, counts: dict):
@@ -61,11 +84,27 @@ def save_parameters(args, log_dir, output_prefix, script_name):
     tool_configs = ['generators', 'counters']
     for tool_config in tool_configs:
         if tool_config in args_dict.keys():
-            args_dict[tool_config + '_configs'] = json.load(open(args_dict[tool_config]))
+            args_dict[tool_config + '_configs'] = load_json(args_dict[tool_config])
     with open(param_file, 'w') as out_file:
         json.dump(args_dict, out_file, indent=4)
 
 
+def load_runtime_stats(path) -> dict:
+    """ Load the expected runtime of each counter, as saved by an earlier
+    fuzzing run. Returns an empty dict if there are no usable statistics.
+    """
+    try:
+        with open(path, 'r') as in_file:
+            return json.load(in_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_runtime_stats(runtime_stats: dict, path):
+    with open(path, 'w') as out_file:
+        json.dump(runtime_stats, out_file, indent=4)
+
+
 def save_problem_instances(problem_instances, log_dir, output_prefix):
     with open(f"{log_dir}/{output_prefix}_problem_instances.txt", 'w') as out_file:
         out_file.write("\n".join(problem_instances))
\ No newline at end of file
@@ -34,12 +34,14 @@ Description: Takes as input a set of model counters and a set of problem
 """
 
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import csv
 from datetime import datetime
 import os
 import re
+import threading
 import time
 from pathlib import Path
-import pandas as pd
 
 # Fuzzer modules
 import file_manager as fm
@@ -47,7 +49,13 @@ import fuzzer_utils as fut
 import report_manager as rm
 
 instances_prefix_pat = re.compile(r'(?P<prefix>\d{4}-\d{2}-\d{2}_s\d+)_generated_instances\.txt', re.DOTALL)
-instance_seed_pat = re.compile(r'[\w\-]+_000_s(?P<seed>\d+)\.\w+', re.DOTALL)
+
+# Seconds a counter may run past its timeout before it is killed
+wallclock_grace = 2
+
+# Counter processes that are currently running. They run in their own session,
+# so they do not get the SIGINT of a Ctrl-C and must be killed explicitly.
+running_counters = set()
 
 
 def parse_arguments():
@@ -99,6 +107,12 @@ def parse_arguments():
         "--verbosity", "-v", type=int, default=2, required=False,
         dest="verbosity", help="Specify verbosity level 1, 2 or 3"
     )
+    behaviour.add_argument(
+        "--fail-fast", dest="fail_fast", default=False, required=False,
+        action="store_true",
+        help="Stop running counters on an instance as soon as two of them disagree. "
+             "The skipped runs are marked in the skipped column of the results csv."
+    )
     behaviour.add_argument(  # TODO: Check if this is actually used
         "--keep-bugs-only", dest="keep_bugs_only", default=False, required=False,
         action="store_true",
@@ -107,6 +121,11 @@ def parse_arguments():
 
     # -------------------------   ADMIN   ------------------------- #
 
+    admin.add_argument(
+        "--jobs", "-j", dest="jobs", type=int, default=1,
+        required=False, help="Maximum number of counter runs to run in parallel. Each run may use up to "
+                             "--memout memory, and parallel runs compete for CPU time."
+    )
     admin.add_argument(
         "--out-dir", dest="out_dir", type=str, required=False,
         help="Specify path to directory to store outputs. Default: /path/to/fuzzer/out"
@@ -158,16 +177,31 @@ def run_counter(counter: fut.Counter,
     if verbosity >= 2:
         rm.log_message(f"Running counter {counter.name} on instance {path_to_instance}.")
 
-    command, counter_dir = fut.construct_command(counter, path_to_instance, memout=memout, timeout=timeout)
+    argv, counter_dir = fut.construct_command(counter, path_to_instance, memout=memout, timeout=timeout)
     start_time = time.time()
-    counter_output, err = fut.run(command.split(), counter_dir + '/', verbosity=verbosity)
-    error = fut.handle_errors(err, verbosity=verbosity)
-    timed_out = fut.handle_timeout(start_time=start_time, timeout=timeout,
-                                   counter_name=counter.name, path_to_instance=path_to_instance)
-
-    return fut.parse_counter_output(
-        counter_output, counter, path_to_instance,
-        timed_out=timed_out, error=error, log_dir=log_dir, command=command)
+    process = fut.start(argv, counter_dir + '/', verbosity=verbosity, env=fut.counter_env(memout, timeout),
+                        new_session=True)
+    # The CPU limit does not stop a counter that hangs without using CPU time,
+    # which would hold on to its worker indefinitely. Kill it once it is well
+    # past its wall-clock deadline; it is then reported as timed out. The whole
+    # process group is killed, since a wrapper script may have started the
+    # actual counter, which then still holds the output pipe open.
+    running_counters.add(process)
+    killer = threading.Timer(timeout + wallclock_grace, fut.kill_process_group, args=(process,))
+    killer.start()
+    try:
+        result = fut.parse_counter_output(
+            process, counter, path_to_instance,
+            start_time=start_time, timeout=timeout, log_dir=log_dir, command=" ".join(argv))
+    finally:
+        killer.cancel()
+        # Do not leave the counter behind if parsing failed half-way
+        if process.poll() is None:
+            fut.kill_process_group(process)
+            process.wait()
+        running_counters.discard(process)
+    result['runtime'] = time.time() - start_time
+    return result
 
 
 def fuzz(instances: [],
@@ -181,66 +215,161 @@ def fuzz(instances: [],
          memout=3200,
          verbosity=1,
          clean_up_proofs=False,
+         jobs=1,
+         fail_fast=False,
          ):
     # Create data structures to store summary of results
-    df = pd.DataFrame(columns=[])
-    log_dir = f"{out_dir}/logs"
-    path_to_csv = f"{out_dir}/{output_prefix}_fuzz-results.csv"
-    path_to_problematic_instances = f"{out_dir}/{output_prefix}_problematic-instances.txt"
+    out_path = Path(out_dir)
+    log_dir = out_path / "logs"
+    path_to_csv = out_path / f"{output_prefix}_fuzz-results.csv"
+    path_to_problematic_instances = out_path / f"{output_prefix}_problematic-instances.txt"
     fm.silent_remove(path_to_problematic_instances)
     problem_instances = []
+    n_saved_problem_instances = None
     verified = False
 
-    # Main loop
+    # Start the counters that took longest in earlier runs first, so that the
+    # slow runs do not all end up at the back of the queue. Counters without
+    # statistics are assumed to be slow.
+    path_to_runtime_stats = out_path / ".runtime_stats.json"
+    runtime_stats = rm.load_runtime_stats(path_to_runtime_stats)
+    run_order = sorted(counters, key=lambda counter: -runtime_stats.get(counter.name, timeout))
+
+    # Results are appended to the csv as they come in, rather than rewriting all
+    # results so far after every instance
+    with open(path_to_csv, 'w', newline='') as csv_file, ThreadPoolExecutor(max_workers=jobs) as executor:
+        writer = None
+        # Every counter run is an independent external process, so run several
+        # at once. The results are collected in the order in which the runs
+        # finish, and each instance is reported once all of its runs are done.
+        # Runs are only submitted when a worker is free to start them, so that
+        # --fail-fast can still skip the runs of an instance whose counters
+        # already disagree.
+        runs = ((i, counter) for i in range(len(instances)) for counter in run_order)
+        running = dict()
+        results = [dict() for _ in instances]
+        n_unfinished = [len(counters)] * len(instances)
+        stopped = [False] * len(instances)
+        n_reported = 0
+
+        # If the main loop fails (including on Ctrl-C), do not wait for the
+        # runs in progress to finish before reporting the error
+        try:
+            # Main loop
+            rm.log_message("")
+            while n_reported < len(instances):
+                for i, counter in runs:
+                    if stopped[i]:
+                        n_unfinished[i] -= 1
+                        continue
+                    running[executor.submit(
+                        run_counter,
+                        counter=counter,
+                        path_to_instance=instances[i],
+                        log_dir=log_dir,
+                        timeout=timeout,
+                        memout=memout,
+                        verbosity=verbosity
+                    )] = (i, counter.name)
+                    if len(running) >= jobs:
+                        break
+
+                done = wait(running, return_when=FIRST_COMPLETED).done if running else ()
+                for run in done:
+                    i, name = running.pop(run)
+                    n_unfinished[i] -= 1
+                    result = run.result()
+                    runtime_stats[name] = 0.9 * runtime_stats.get(name, result['runtime']) + 0.1 * result['runtime']
+                    results[i][name] = result
+
+                    counts = {counter_name: counter_result['count_value']
+                              for counter_name, counter_result in results[i].items()}
+                    if verified_counts is not None:
+                        counts['verified_count'] = verified_counts[instances[i]]['verified_count']
+                    # Compare the counts reported so far the same way as the final
+                    # verdict below, so that e.g. '1024' and '1024.0' agree. Failed
+                    # runs have no count, and unverified instances a NaN count.
+                    reported = {name: count for name, count in counts.items() if not fut.is_nan_or_none(count)}
+                    if fail_fast and len(reported) > 1 and not fut.check_counts(reported):
+                        # Two counts already disagree, so the instance is problematic
+                        # whatever the remaining counters report: skip the runs that
+                        # have not started yet.
+                        stopped[i] = True
+
+                # Report the instances whose runs are all done, in their original
+                # order, so that the csv and the log do not depend on the run order
+                while n_reported < len(instances) and n_unfinished[n_reported] == 0:
+                    path_to_instance = instances[n_reported]
+                    rm.log_message("")
+                    rm.log_message(f"Instance {n_reported+1}/{len(instances)}: {path_to_instance}", print_time=True)
+                    # TODO: Handle preprocessing
+                    # TODO: Handle delta-debugging
+                    counts = dict()
+                    # Fields that are the same for all counters on this instance
+                    static_fields = {'generator': fut.get_generator(path_to_instance)}
+                    if verified_counts is not None:
+                        verified_entry = verified_counts[path_to_instance]
+                        verified = verified_entry['verified']
+                        counts['verified_count'] = verified_entry['verified_count']
+                        static_fields['verified_count'] = verified_entry['verified_count']
+                    static_fields['verified'] = verified
+                    rows = []
+                    for counter in counters:
+                        if counter.name in results[n_reported]:
+                            result = results[n_reported][counter.name]
+                            counts[counter.name] = result['count_value']
+                            result['skipped'] = False
+                        else:
+                            # Not run, because --fail-fast had already found a disagreement
+                            result = {'counter': counter.name, 'instance': path_to_instance,
+                                      'timed_out': False, 'error': False, 'skipped': True}
+                        result.update(static_fields)
+                        rows.append(result)
+
+                    if writer is None:
+                        # Skipped rows leave the fields of a run empty
+                        fieldnames = next(list(row.keys()) for row in rows if not row['skipped'])
+                        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+                        writer.writeheader()
+                    writer.writerows(rows)
+                    skipped = [row['counter'] for row in rows if row['skipped']]
+                    if skipped:
+                        rm.log_message(f"Skipped {', '.join(skipped)}, because the counters already disagree.")
+
+                    if len(counts) == 1:
+                        name = counters[0].name
+                        rm.log_message(f"Counter {name} reports count {counts[name]}")
+                        if result['error']:
+                            problem_instances.append(path_to_instance)
+                    else:
+                        same_counts = fut.check_counts(counts)
+                        rm.print_counts(same_counts, counts)
+                        if same_counts:
+                            if clean_up_proofs:
+                                fm.clean_up_proof(instance=path_to_instance)
+                                if verbosity >= 2:
+                                    rm.log_message(f"Cleaned up proof files for instance {path_to_instance}.")
+                        else:
+                            problem_instances.append(path_to_instance)
+
+                    # Every iteration, store results. The list of problem instances
+                    # is only rewritten when it has changed.
+                    csv_file.flush()
+                    if len(problem_instances) != n_saved_problem_instances:
+                        rm.save_problem_instances(problem_instances, log_dir, output_prefix)
+                        n_saved_problem_instances = len(problem_instances)
+                    results[n_reported] = None
+                    n_reported += 1
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            # Runs that have already started would otherwise keep going until
+            # their timeout, or outlive the fuzzer altogether
+            for process in list(running_counters):
+                fut.kill_process_group(process)
+            raise
+    rm.save_runtime_stats(runtime_stats, path_to_runtime_stats)
     rm.log_message("")
-    for i, path_to_instance in enumerate(instances):
-        rm.log_message("")
-        rm.log_message(f"Instance {i+1}/{len(instances)}: {path_to_instance}", print_time=True)
-        # TODO: Handle preprocessing
-        # TODO: Handle delta-debugging
-        counts = dict()
-        if verified_counts is not None:
-            verified = verified_counts[path_to_instance]['verified']
-            verified_count_str = verified_counts[path_to_instance]['verified_count']
-            counts['verified_count'] = verified_count_str
-        for counter in counters:
-            result = run_counter(
-                counter=counter,
-                path_to_instance=path_to_instance,
-                log_dir=log_dir,
-                timeout=timeout,
-                memout=memout,
-                verbosity=verbosity
-            )
-            counts[counter.name] = result['count_value']
-            result['generator'] = fut.get_generator(path_to_instance)
-            if verified_counts is not None:
-                result['verified_count'] = counts['verified_count']
-            result['verified'] = verified
-
-            df = pd.concat([df, pd.DataFrame([result])], ignore_index=True)
-
-        if len(counts) == 1:
-            name = counters[0].name
-            rm.log_message(f"Counter {name} reports count {counts[name]}")
-            if result['error']:
-                problem_instances.append(path_to_instance)
-        else:
-            same_counts = fut.check_counts(counts)
-            rm.print_counts(same_counts, counts)
-            if same_counts:
-                if clean_up_proofs:
-                    fm.clean_up_proof(instance=path_to_instance)
-                    if verbosity >= 2:
-                        rm.log_message(f"Cleaned up proof files for instance {path_to_instance}.")
-            else:
-                problem_instances.append(path_to_instance)
-
-        # Every iteration, store results:
-        df.to_csv(path_to_csv)
-        rm.save_problem_instances(problem_instances, log_dir, output_prefix)
-    rm.log_message("")
-    return path_to_csv, problem_instances
+    return str(path_to_csv), problem_instances
 
 
 if __name__ == "__main__":
@@ -253,17 +382,15 @@ if __name__ == "__main__":
 
     os.makedirs(args.log_dir, exist_ok=True)
 
-    os.environ['STAREXEC_WALLCLOCK_LIMIT'] = str(args.timeout)
-    os.environ['STAREXEC_MAX_MEM'] = str(args.memout)
-
     output_prefix = ''
     if os.path.isfile(args.instances):
-        m = re.match(instances_prefix_pat, os.path.basename(args.instances))
+        m = instances_prefix_pat.match(os.path.basename(args.instances))
         output_prefix = m.group('prefix')
     else:
-        print(os.path.basename(sorted(instances)[0]))
-        m = re.match(instance_seed_pat, os.path.basename(sorted(instances)[0]))
-        output_prefix = f"{datetime.now().strftime('%Y-%m-%d')}_s{m.group('seed')}"
+        first_instance = os.path.basename(min(instances))
+        print(first_instance)
+        seed = fut.extract_seed(first_instance)
+        output_prefix = f"{datetime.now().strftime('%Y-%m-%d')}_s{seed}"
 
     rm.save_parameters(args, args.log_dir, output_prefix, os.path.basename(__file__))
     # TODO: save parameters
@@ -279,7 +406,9 @@ if __name__ == "__main__":
         timeout=args.timeout,
         memout=args.memout,
         verbosity=args.verbosity,
-        clean_up_proofs=args.clean_up_proofs
+        clean_up_proofs=args.clean_up_proofs,
+        jobs=args.jobs,
+        fail_fast=args.fail_fast
     )
 
     rm.log_message("FINISHED!", print_time=True)
@@ -26,13 +26,36 @@ License:     GPLv3
     02110-1301, USA.
 """
 
-from collections import namedtuple
-
-Counter = namedtuple("Counter", "name path config exact",
-                     defaults=[None, None, None, True])
-Generator = namedtuple("Generator", "name path config",
-                       defaults=[None, None, None])
-Preprocessor = namedtuple("Preprocessor", "name path config",
-                          defaults=[None, None, None])
-DeltaDebugger = namedtuple("DeltaDebugger", "name path config",
-                           defaults=[None, None, None])
\ No newline at end of file
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True, slots=True)
+class Counter:
+    name: str | None = None
+    path: str | None = None
+    config: str | None = None
+    exact: bool = True
+    dir: str | None = None
+    argv: tuple | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class Generator:
+    name: str | None = None
+    path: str | None = None
+    config: str | None = None
+    template: str | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class Preprocessor:
+    name: str | None = None
+    path: str | None = None
+    config: str | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class DeltaDebugger:
+    name: str | None = None
+    path: str | None = None
+    config: str | None = None